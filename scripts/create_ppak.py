@@ -6,14 +6,110 @@ Creates .ppak files for the Teenage Engineering EP-133 sampler.
 """
 
 import struct
+import functools
+import operator
 import tarfile
 import zipfile
 import io
 import json
 import os
 import shutil
-from datetime import datetime
-from typing import Dict, List, Tuple, Optional
+from datetime import datetime, timezone
+from bisect import insort
+from typing import Dict, Iterable, List, Tuple, Optional
+
+
+# Pad sample number (uint16LE at bytes 1-2)
+_U16 = struct.Struct('<H')
+
+# Minimal 27-byte pad file
+_DEFAULT_PAD = bytes(27)
+
+# Pad file names (p01-p12) and their paths inside the project tar
+_PAD_NAMES = [f'p{pad:02d}' for pad in range(1, 13)]
+_PAD_NUMBERS = {name: pad for pad, name in enumerate(_PAD_NAMES, 1)}
+_PAD_RELPATHS = {
+    (group, pad): f'pads/{group}/{name}'
+    for group in ['a', 'b', 'c', 'd']
+    for pad, name in enumerate(_PAD_NAMES, 1)
+}
+
+# Pattern event (8 bytes): time (uint16LE), row, column, velocity, flags (0x10 0x00 0x00).
+# Everything after the time depends only on pad and velocity, so both halves
+# are precomputed: time prefixes for one bar and per-pad/velocity tails.
+_EVENT_TIMES = [time.to_bytes(2, 'little') for time in range(384)]
+_EVENT_TAILS = [
+    [bytes([(pad - 1) * 8, 0x3c, velocity, 0x10, 0x00, 0x00]) for velocity in range(128)]
+    for pad in range(1, 13)
+]
+
+# Pattern with no events: header only
+_EMPTY_PATTERN = b'\x00\x01\x00\x00'
+
+
+def _encode_pattern(events: List[Tuple[int, int, int]]) -> bytes:
+    """Encode a list of (time, pad, velocity) events as binary pattern data"""
+    if not events:
+        return _EMPTY_PATTERN
+
+    n = len(events)
+    if n > 255:
+        raise ValueError(f"Too many events: {n}. Maximum is 255")
+
+    # project.patterns is public, so check ranges before indexing the lookup tables
+    # (negative values would otherwise wrap around to the wrong entry)
+    if not all(0 <= time <= 383 and 1 <= pad <= 12 and 0 <= velocity <= 127
+               for time, pad, velocity in events):
+        for time, pad, velocity in events:
+            _validate_event(time, pad, velocity)
+
+    # add_event/extend_events keep patterns in time order; anything appended
+    # directly may not be, so check in one pass and sort a copy only if needed
+    if any(events[i][0] > events[i + 1][0] for i in range(n - 1)):
+        events = sorted(events, key=operator.itemgetter(0))
+
+    parts = [bytes((0x00, 0x01, n, 0x00))]
+    append = parts.append
+    for time, pad, velocity in events:
+        append(_EVENT_TIMES[time])
+        append(_EVENT_TAILS[pad - 1][velocity])
+
+    return b''.join(parts)
+
+
+@functools.lru_cache(maxsize=512)
+def _pad_bytes(template: bytes, sample_num: int) -> bytes:
+    """Return pad data from a template with the sample number set at bytes 1-2"""
+    data = bytearray(template)
+    _U16.pack_into(data, 1, sample_num)
+    return bytes(data)
+
+
+@functools.lru_cache(maxsize=16)
+def _meta_template(device_sku: str) -> str:
+    """Return meta.json text with a "__TS__" placeholder for generated_at"""
+    return json.dumps({
+        "info": "teenage engineering - pak file",
+        "pak_version": 1,
+        "pak_type": "user",
+        "pak_release": "1.2.0",
+        "device_name": "EP-133",
+        "device_sku": device_sku,
+        "device_version": "2.0.5",
+        "generated_at": "__TS__",
+        "author": "Claude",
+        "base_sku": device_sku
+    }, indent=2)
+
+
+def _validate_event(time: int, pad: int, velocity: int):
+    """Raise ValueError if an event field is out of range"""
+    if not 0 <= time <= 383:
+        raise ValueError(f"Invalid time: {time}. Must be 0-383")
+    if not 1 <= pad <= 12:
+        raise ValueError(f"Invalid pad: {pad}. Must be 1-12")
+    if not 0 <= velocity <= 127:
+        raise ValueError(f"Invalid velocity: {velocity}. Must be 0-127")
 
 
 class EP133Project:
@@ -32,6 +128,7 @@ class EP133Project:
         self.pad_assignments: Dict[str, Dict[int, int]] = {
             'a': {}, 'b': {}, 'c': {}, 'd': {}
         }
+        # (time, pad, velocity) events per pattern, kept sorted by add_event/extend_events
         self.patterns: Dict[str, List[Tuple[int, int, int]]] = {
             'a01': [], 'b01': [], 'c01': [], 'd01': []
         }
@@ -47,33 +144,42 @@ class EP133Project:
             backup_path: Path to .ppak or extracted backup directory
         """
         if backup_path.endswith('.ppak') or backup_path.endswith('.pak'):
-            # Extract from archive
-            import tempfile
-            with tempfile.TemporaryDirectory() as tmpdir:
-                with zipfile.ZipFile(backup_path, 'r') as zf:
-                    zf.extractall(tmpdir)
-                # Find and extract tar
-                for root, dirs, files in os.walk(tmpdir):
-                    for f in files:
-                        if f.endswith('.tar'):
-                            tar_path = os.path.join(root, f)
-                            with tarfile.open(tar_path, 'r') as tar:
-                                tar.extractall(tmpdir)
-                            break
-                self._load_templates_from_dir(tmpdir)
+            self._load_templates_from_archive(backup_path)
         else:
             self._load_templates_from_dir(backup_path)
 
+    def _load_templates_from_archive(self, archive_path: str):
+        """Load templates by streaming the project tar out of a backup archive"""
+        self._template_pads = {group: {} for group in ['a', 'b', 'c', 'd']}
+
+        with zipfile.ZipFile(archive_path, 'r') as zf:
+            tar_name = next((name for name in zf.namelist() if name.endswith('.tar')), None)
+            if tar_name is None:
+                return
+            with zf.open(tar_name) as tar_stream, \
+                    tarfile.open(fileobj=tar_stream, mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    parts = [part for part in member.name.split('/') if part not in ('', '.')]
+                    if parts == ['settings']:
+                        self._template_settings = tar.extractfile(member).read()
+                    elif (len(parts) == 3 and parts[0] == 'pads'
+                          and parts[1] in self._template_pads and parts[2] in _PAD_NUMBERS):
+                        pad = _PAD_NUMBERS[parts[2]]
+                        self._template_pads[parts[1]][pad] = tar.extractfile(member).read()
+
     def _load_templates_from_dir(self, dir_path: str):
         """Load templates from extracted directory"""
         self._template_pads = {}
         for group in ['a', 'b', 'c', 'd']:
             self._template_pads[group] = {}
-            for pad in range(1, 13):
-                pad_path = os.path.join(dir_path, 'pads', group, f'p{pad:02d}')
+            group_dir = os.path.join(dir_path, 'pads', group)
+            for pad, name in enumerate(_PAD_NAMES, 1):
+                pad_path = os.path.join(group_dir, name)
                 if os.path.exists(pad_path):
                     with open(pad_path, 'rb') as f:
-                        self._template_pads[group][pad] = bytearray(f.read())
+                        self._template_pads[group][pad] = f.read()
 
         settings_path = os.path.join(dir_path, 'settings')
         if os.path.exists(settings_path):
@@ -107,14 +213,33 @@ class EP133Project:
         """
         if pattern not in self.patterns:
             raise ValueError(f"Invalid pattern: {pattern}. Must be a01, b01, c01, or d01")
-        if not 0 <= time <= 383:
-            raise ValueError(f"Invalid time: {time}. Must be 0-383")
-        if not 1 <= pad <= 12:
-            raise ValueError(f"Invalid pad: {pad}. Must be 1-12")
-        if not 0 <= velocity <= 127:
-            raise ValueError(f"Invalid velocity: {velocity}. Must be 0-127")
+        _validate_event(time, pad, velocity)
+
+        # Keep each pattern sorted by time so saving needs no sort
+        insort(self.patterns[pattern], (time, pad, velocity))
+
+    def extend_events(self, pattern: str, events: Iterable[Tuple[int, int, int]]):
+        """
+        Add several events to a pattern at once.
+
+        Args:
+            pattern: Pattern name ('a01', 'b01', 'c01', 'd01')
+            events: Iterable of (time, pad, velocity) tuples
+        """
+        if pattern not in self.patterns:
+            raise ValueError(f"Invalid pattern: {pattern}. Must be a01, b01, c01, or d01")
+
+        events = [(time, pad, velocity) for time, pad, velocity in events]
+        # Validate the whole batch in one pass; only pinpoint the bad event on failure
+        if not all(0 <= time <= 383 and 1 <= pad <= 12 and 0 <= velocity <= 127
+                   for time, pad, velocity in events):
+            for time, pad, velocity in events:
+                _validate_event(time, pad, velocity)
 
-        self.patterns[pattern].append((time, pad, velocity))
+        events.sort()
+        self.patterns[pattern].extend(events)
+        # Both runs are now sorted, so this sort is a cheap merge
+        self.patterns[pattern].sort()
 
     def add_kick(self, pattern: str, time: int, pad: int = 10, velocity: int = 127):
         """Convenience method for adding kick drum hits"""
@@ -130,127 +255,99 @@ class EP133Project:
 
     def _create_pattern_data(self, events: List[Tuple[int, int, int]]) -> bytes:
         """Convert event list to binary pattern data"""
-        if not events:
-            return bytes([0x00, 0x01, 0x00, 0x00])
-
-        events = sorted(events, key=lambda x: x[0])
-
-        if len(events) > 255:
-            raise ValueError(f"Too many events: {len(events)}. Maximum is 255")
-
-        header = bytes([0x00, 0x01, len(events), 0x00])
-        data = header
-
-        for time, pad, velocity in events:
-            row = (pad - 1) * 8
-            col = 0x3c  # Standard playback
-            event = struct.pack('<H', time) + bytes([row, col, velocity, 0x10, 0x00, 0x00])
-            data += event
-
-        return data
+        return _encode_pattern(events)
 
     def _create_pad_data(self, group: str, pad: int) -> bytes:
         """Create binary pad data"""
         # Use template if available
         if self._template_pads and group in self._template_pads and pad in self._template_pads[group]:
-            data = bytearray(self._template_pads[group][pad])
+            template = self._template_pads[group][pad]
         else:
-            # Minimal 27-byte pad file
-            data = bytearray(27)
+            template = _DEFAULT_PAD
 
-        # Set sample number at bytes 1-2
         sample_num = self.pad_assignments[group].get(pad, 0)
-        data[1:3] = struct.pack('<H', sample_num)
-
-        return bytes(data)
+        if sample_num == 0 and template[1] == 0 and template[2] == 0:
+            # Unassigned pad and the template already has no sample
+            return template
+        return _pad_bytes(template, sample_num)
 
     def save(self, output_path: str, sounds_dir: Optional[str] = None):
         """
         Save the project as a .ppak file.
 
+        Does not modify the project (out-of-order patterns are sorted on a
+        copy) and touches no process-wide state, so separate projects can be
+        saved concurrently (e.g. from a ThreadPoolExecutor) when batch-generating.
+
         Args:
             output_path: Output .ppak file path
             sounds_dir: Directory containing .wav sound files (optional)
         """
-        import tempfile
-
-        with tempfile.TemporaryDirectory() as work_dir:
-            # Create directory structure
-            for group in ['a', 'b', 'c', 'd']:
-                os.makedirs(os.path.join(work_dir, 'pads', group), exist_ok=True)
-            os.makedirs(os.path.join(work_dir, 'patterns'), exist_ok=True)
-
-            # Write pad files
-            for group in ['a', 'b', 'c', 'd']:
-                for pad in range(1, 13):
-                    pad_path = os.path.join(work_dir, 'pads', group, f'p{pad:02d}')
-                    with open(pad_path, 'wb') as f:
-                        f.write(self._create_pad_data(group, pad))
-
-            # Write pattern files
-            for pattern_name, events in self.patterns.items():
-                pattern_path = os.path.join(work_dir, 'patterns', pattern_name)
-                with open(pattern_path, 'wb') as f:
-                    f.write(self._create_pattern_data(events))
-
-            # Write settings
-            settings_path = os.path.join(work_dir, 'settings')
-            if self._template_settings:
-                with open(settings_path, 'wb') as f:
-                    f.write(self._template_settings)
-            else:
-                # Minimal settings (222 bytes)
-                with open(settings_path, 'wb') as f:
-                    f.write(bytes(222))
-
-            # Create tar
-            tar_buffer = io.BytesIO()
-            orig_dir = os.getcwd()
-            os.chdir(work_dir)
-            try:
-                with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
-                    tar.add('pads')
-                    tar.add('patterns')
-                    tar.add('settings')
-            finally:
-                os.chdir(orig_dir)
-            tar_data = tar_buffer.getvalue()
-
-            # Create meta.json
-            meta = {
-                "info": "teenage engineering - pak file",
-                "pak_version": 1,
-                "pak_type": "user",
-                "pak_release": "1.2.0",
-                "device_name": "EP-133",
-                "device_sku": self.device_sku,
-                "device_version": "2.0.5",
-                "generated_at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-                "author": "Claude",
-                "base_sku": self.device_sku
-            }
-
-            # Create .ppak (ZIP with leading slashes)
-            with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                # Add tar
-                info = zipfile.ZipInfo(f'/projects/P{self.project_num:02d}.tar')
-                info.compress_type = zipfile.ZIP_DEFLATED
-                zf.writestr(info, tar_data)
-
-                # Add meta.json
-                info = zipfile.ZipInfo('/meta.json')
-                info.compress_type = zipfile.ZIP_DEFLATED
-                zf.writestr(info, json.dumps(meta, indent=2))
-
-                # Add sounds
-                if sounds_dir and os.path.isdir(sounds_dir):
-                    for fname in sorted(os.listdir(sounds_dir)):
-                        if fname.lower().endswith('.wav'):
-                            fpath = os.path.join(sounds_dir, fname)
-                            with open(fpath, 'rb') as sf:
-                                info = zipfile.ZipInfo(f'/sounds/{fname}')
-                                info.compress_type = zipfile.ZIP_DEFLATED
-                                zf.writestr(info, sf.read())
+        # Collect tar members in archive order (None marks a directory)
+        members: List[Tuple[str, Optional[bytes]]] = [('pads', None)]
+        for group in ['a', 'b', 'c', 'd']:
+            members.append((f'pads/{group}', None))
+            for pad in range(1, 13):
+                members.append((_PAD_RELPATHS[group, pad], self._create_pad_data(group, pad)))
+
+        members.append(('patterns', None))
+        for pattern_name, events in self.patterns.items():
+            members.append((f'patterns/{pattern_name}', self._create_pattern_data(events)))
+
+        if self._template_settings:
+            members.append(('settings', self._template_settings))
+        else:
+            # Minimal settings (222 bytes)
+            members.append(('settings', bytes(222)))
+
+        # Create tar (fixed mtime so the tar is reproducible between runs)
+        tar_buffer = io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w|', bufsize=16384) as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.mtime = 0
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    info.mode = 0o644
+                    tar.addfile(info, io.BytesIO(data))
+
+        # Create meta.json
+        generated_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        meta = _meta_template(self.device_sku).replace('"__TS__"', json.dumps(generated_at))
+
+        # Create .ppak (ZIP with leading slashes)
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            # Add tar
+            info = zipfile.ZipInfo(f'/projects/P{self.project_num:02d}.tar')
+            # Mostly tar headers and padding around small binary blobs; not worth DEFLATE
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = tar_buffer.tell()
+            tar_buffer.seek(0)
+            with zf.open(info, 'w') as dest:
+                shutil.copyfileobj(tar_buffer, dest, 1 << 20)
+
+            # Add meta.json
+            info = zipfile.ZipInfo('/meta.json')
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, meta)
+
+            # Add sounds
+            if sounds_dir and os.path.isdir(sounds_dir):
+                for fname in sorted(os.listdir(sounds_dir)):
+                    if fname.lower().endswith('.wav'):
+                        fpath = os.path.join(sounds_dir, fname)
+                        info = zipfile.ZipInfo(f'/sounds/{fname}')
+                        # PCM audio gains almost nothing from DEFLATE
+                        info.compress_type = zipfile.ZIP_STORED
+                        # Known size up front lets zipfile pick ZIP64 only when needed
+                        info.file_size = os.path.getsize(fpath)
+                        # Stream in chunks rather than reading whole samples into memory
+                        with open(fpath, 'rb') as sf, zf.open(info, 'w') as dest:
+                            shutil.copyfileobj(sf, dest, 1 << 16)
 
         return output_path
 
@@ -273,18 +370,20 @@ def create_basic_beat(project: EP133Project,
                       snare_pad: int = 7,
                       hihat_pad: int = 5):
     """Add a basic 4/4 beat to pattern a01"""
-    # Kick on 1 and 3
-    project.add_event('a01', 0, kick_pad, 127)
-    project.add_event('a01', 192, kick_pad, 127)
-
-    # Snare on 2 and 4
-    project.add_event('a01', 96, snare_pad, 120)
-    project.add_event('a01', 288, snare_pad, 120)
+    events = [
+        # Kick on 1 and 3
+        (0, kick_pad, 127),
+        (192, kick_pad, 127),
+        # Snare on 2 and 4
+        (96, snare_pad, 120),
+        (288, snare_pad, 120),
+    ]
 
     # Hi-hats on 8th notes
-    for i in range(8):
-        vel = 90 if i % 2 == 0 else 70
-        project.add_event('a01', i * 48, hihat_pad, vel)
+    events.extend((i * TICKS_PER_8TH, hihat_pad, 90 if i % 2 == 0 else 70)
+                  for i in range(8))
+
+    project.extend_events('a01', events)
 
 
 if __name__ == '__main__':